@@ -1,15 +1,23 @@
 # bot.py
 # Главный файл бота, запускает бота и планировщик задач.
 import asyncio
+import functools
+import heapq
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.types import BotCommand
-from datetime import datetime, timedelta, time
-import pytz
+from datetime import date, datetime, timedelta, time, timezone
+from typing import List, Tuple
+from zoneinfo import ZoneInfo
 from config import BOT_TOKEN
 from handlers import router
-from database import create_tables, get_all_medicines_with_time, get_user_timezone, decrement_medicine_quantity, get_medicine_by_id, delete_medicine
+from database import create_tables, close_db, get_reminder_schedule, reminders_changed, take_medicine_doses
+
+try:
+    import uvloop # Более быстрый цикл событий на основе libuv, недоступен на Windows.
+except ImportError:
+    uvloop = None
 
 # bot.py
 # aiogram: 3.x.x
@@ -30,69 +38,127 @@ async def set_commands(bot: Bot):
     ]
     await bot.set_my_commands(commands)
 
-async def send_reminder(bot: Bot, user_id: int, medicine_id: int, medicine_name: str, medicine_dosage: str, medicine_dosage_unit: str): # Добавили medicine_dosage_unit
+async def send_reminders(bot: Bot, user_id: int, reminders: List[Tuple[int, str, str, float, str]]) -> bool:
     """
-    Отправка напоминания пользователю о приеме лекарства.
-    Уменьшает количество оставшихся доз в базе данных и удаляет лекарство, если оно закончилось.
+    Отправка пользователю одного сообщения обо всех лекарствах, время приема которых наступило.
+    reminders - список кортежей (medicine_id, название, доза для отображения, доза числом, единица измерения).
+    Возвращает True, если сообщение доставлено и дозы можно списывать с остатка.
     """
-    logging.info(f"Отправка напоминания пользователю {user_id}: {medicine_name} (доза: {medicine_dosage} {medicine_dosage_unit})")
+    if logging.getLogger().isEnabledFor(logging.DEBUG): # Список лекарств собирается, только если DEBUG-лог включен.
+        logging.debug("Отправка напоминания пользователю %s: %s", user_id, ", ".join(f"{name} (доза: {dose} {unit})" for _, name, dose, _, unit in reminders))
     try:
-        dosage_str = medicine_dosage.rstrip('0').rstrip('.') if '.' in medicine_dosage else medicine_dosage # Убираем лишние нули и точку из дробной части для красивого отображения дозировки.
-        dosage_value = float(medicine_dosage)
-
-        unit_text = medicine_dosage_unit
-        reminder_message = f"⏰ Напоминание! Примите {dosage_str} {unit_text} {medicine_name} 💊"
-        await bot.send_message(user_id, reminder_message)
-        logging.info(f"Напоминание успешно отправлено пользователю {user_id}")
-        medicine_info = await get_medicine_by_id(medicine_id) # Получение информации о лекарстве из базы данных.
-        if medicine_info:
-            current_remaining_quantity = medicine_info[5] # remaining_quantity - 6й элемент в кортеже (после добавления dosage_unit)
-            if current_remaining_quantity > 0:
-                dosage_val = 1 # Доза по умолчанию для уменьшения остатка (если не удастся распарсить дозировку, хотя теперь дозировка - число).
-                try:
-                    dosage_val = float(medicine_dosage) # Попытка преобразования дозировки в число.
-                except ValueError:
-                    logging.warning(f"Не удалось распарсить дозировку '{medicine_dosage}' для medicine_id {medicine_id}, используем дозу по умолчанию 1 для уменьшения остатка.")
-
-                await decrement_medicine_quantity(medicine_id, dosage_val) # Уменьшение оставшегося количества лекарства в БД.
-                updated_medicine_info = await get_medicine_by_id(medicine_id) # Получение обновленной информации о лекарстве.
-                if updated_medicine_info and updated_medicine_info[5] <= 0: # Проверка, что лекарство закончилось.
-                    await bot.send_message(user_id, f"💊 Внимание! Лекарство '{medicine_name}' закончилось. Пожалуйста, пополните запасы. ⏳")
-                    await delete_medicine(medicine_id) # Автоматическое удаление лекарства из базы данных.
-            elif current_remaining_quantity <= 0:
-                logging.info(f"Лекарство {medicine_name} (medicine_id {medicine_id}) уже закончилось или остаток <= 0, напоминание не приведет к уменьшению остатка.")
+        lines = [f"⏰ Напоминание! Примите {dose} {dosage_unit} {name} 💊" for _, name, dose, _, dosage_unit in reminders]
+        await bot.send_message(user_id, "\n".join(lines))
+        logging.info("Напоминание успешно отправлено пользователю %s", user_id)
+        return True
+    except Exception as e:
+        logging.error("Ошибка при отправке напоминания пользователю %s: %s", user_id, e)
+        return False
 
+async def send_finished_notice(bot: Bot, user_id: int, medicine_names: List[str]):
+    """
+    Отправка пользователю одного сообщения обо всех лекарствах, которые закончились после приема.
+    """
+    try:
+        await bot.send_message(user_id, "\n".join(f"💊 Внимание! Лекарство '{name}' закончилось. Пожалуйста, пополните запасы. ⏳" for name in medicine_names))
     except Exception as e:
-        logging.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
+        logging.error("Ошибка при отправке уведомления об окончании лекарства пользователю %s: %s", user_id, e)
+
+async def fire_reminders(bot: Bot, due_by_user: dict):
+    """
+    Отправка наступивших напоминаний (по одному сообщению на пользователя, параллельно).
+    Дозы по доставленным напоминаниям списываются одной транзакцией, закончившиеся лекарства удаляются.
+    """
+    users = list(due_by_user)
+    delivered = await asyncio.gather(*(send_reminders(bot, user_id, due_by_user[user_id]) for user_id in users))
+    taken_doses = [
+        (medicine_id, dose_value)
+        for user_id, sent in zip(users, delivered) if sent
+        for medicine_id, _, _, dose_value, _ in due_by_user[user_id]
+    ]
+    finished_by_user = {} # user_id -> названия закончившихся лекарств.
+    for medicine_id, user_id, name in await take_medicine_doses(taken_doses): # Уменьшение остатков в базе данных.
+        finished_by_user.setdefault(user_id, []).append(name)
+    await asyncio.gather(*(send_finished_notice(bot, user_id, names) for user_id, names in finished_by_user.items()))
+
+MISSED_REMINDER_GRACE = timedelta(minutes=1) # Напоминания, опоздавшие сильнее (например, после сна машины), не отправляются.
+MAX_SCHEDULER_SLEEP = timedelta(hours=1) # Самый долгий сон планировщика без проверки настенных часов.
+
+@functools.lru_cache(maxsize=512)
+def get_zone(timezone_name: str) -> ZoneInfo:
+    """
+    Получение объекта часового пояса по названию, например "Europe/Moscow".
+    Каждый часовой пояс загружается из базы tzdata один раз за время работы бота.
+    """
+    return ZoneInfo(timezone_name)
+
+def next_fire_time(hh: int, mm: int, timezone_name: str, after_utc: datetime, local_date: date | None = None) -> datetime:
+    """
+    Ближайший после after_utc момент (в UTC), когда в часовом поясе пользователя наступает время ЧЧ:ММ.
+    Переходы на летнее/зимнее время учитываются, поэтому сутки не всегда равны 24 часам.
+    local_date - дата after_utc в часовом поясе пользователя, если она уже посчитана.
+    """
+    user_timezone = get_zone(timezone_name) # Преобразование часового пояса из строки в объект ZoneInfo.
+    fire_date = local_date or after_utc.astimezone(user_timezone).date()
+    while True:
+        fire_utc = datetime.combine(fire_date, time(hh, mm), tzinfo=user_timezone).astimezone(timezone.utc)
+        if fire_utc > after_utc:
+            return fire_utc
+        fire_date += timedelta(days=1)
 
 async def scheduler_setup(bot: Bot):
     """
     Настройка и запуск планировщика задач для отправки напоминаний.
-    Проверяет базу данных каждую минуту на наличие напоминаний, которые нужно отправить.
+    Держит кучу (heapq) ближайших срабатываний и спит до первого из них (но не дольше MAX_SCHEDULER_SLEEP).
+    При изменении лекарств или часовых поясов (событие reminders_changed) расписание пересобирается.
     """
-    logging.info("Запуск фоновой задачи проверки напоминаний каждую минуту")
+    logging.info("Запуск планировщика напоминаний")
+    processed_until = datetime.now(timezone.utc) # Все напоминания до этого момента уже обработаны.
     while True:
-        now_utc = datetime.now(pytz.utc) # Текущее время в UTC.
-        medicines = await get_all_medicines_with_time() # Получение всех лекарств с временем приема из базы данных.
-        logging.info(f"Проверка напоминаний на {now_utc.strftime('%H:%M UTC')}. Найдено лекарств для проверки: {len(medicines)}")
-
-        for medicine_id, user_id, name, dosage_str, dosage_unit, reminder_time_str, remaining_quantity in medicines: # Получаем dosage_unit и remaining_quantity из базы
-            user_timezone_str = await get_user_timezone(user_id) # Получение часового пояса пользователя из базы данных.
-            if user_timezone_str:
-                user_timezone = pytz.timezone(user_timezone_str) # Преобразование часового пояса из строки в объект pytz.
-                reminder_times = [datetime.strptime(rt.strip(), "%H:%M").time() for rt in reminder_time_str.split(',')] # Разделение и преобразование времени приема из строки в объекты time.
-                dosages = [d.strip() for d in dosage_str.split(',')] # Разделение дозировок.
-                now_user_tz = now_utc.astimezone(user_timezone) # Текущее время в часовом поясе пользователя.
-
-                for index, reminder_time in enumerate(reminder_times): # Итерация по времени приема лекарства.
-                    if now_user_tz.hour == reminder_time.hour and now_user_tz.minute == reminder_time.minute: # Проверка, совпадает ли текущее время с временем приема.
-                        dose_to_send = dosages[index] if index < len(dosages) else dosages[-1] if dosages else "не указана" # Выбор дозировки для отправки в напоминании.
-                        logging.info(f"Время отправлять напоминание для пользователя {user_id}, лекарство {name}, время {reminder_time.strftime('%H:%M')}, доза {dose_to_send} {dosage_unit}")
-                        await send_reminder(bot, user_id, medicine_id, name, dose_to_send, dosage_unit) # Отправка напоминания, передаем dosage_unit
-            else:
-                logging.warning(f"Не удалось получить часовой пояс для пользователя {user_id}, напоминание для лекарства {name} не будет отправлено в этот раз.")
-
-        await asyncio.sleep(60) # Пауза в 60 секунд перед следующей проверкой.
+        reminders_changed.clear()
+        reminders = {} # (medicine_id, dose_index) -> строка расписания из базы данных.
+        heap = [] # Куча из (время срабатывания в UTC, medicine_id, dose_index).
+        local_dates = {} # Дата processed_until в каждом часовом поясе, считается один раз на пояс.
+        for row in await get_reminder_schedule():
+            medicine_id, dose_index, hh, mm, timezone_name = row[:5]
+            reminders[(medicine_id, dose_index)] = row
+            if timezone_name not in local_dates:
+                local_dates[timezone_name] = processed_until.astimezone(get_zone(timezone_name)).date()
+            heap.append((next_fire_time(hh, mm, timezone_name, processed_until, local_dates[timezone_name]), medicine_id, dose_index))
+        heapq.heapify(heap)
+        logging.info("Расписание напоминаний обновлено, запланировано: %d", len(heap))
+
+        while not reminders_changed.is_set():
+            now_utc = datetime.now(timezone.utc)
+            # Сон до ближайшего напоминания (оно всегда приходится на начало минуты). Таймер asyncio идет по монотонным часам,
+            # которые не следуют за переводом системных часов (NTP, ручная установка), поэтому сон ограничен MAX_SCHEDULER_SLEEP:
+            # после такого перевода расписание сверяется с настенными часами не позже чем через этот интервал.
+            wake_at = now_utc + MAX_SCHEDULER_SLEEP
+            if heap:
+                wake_at = min(wake_at, heap[0][0])
+            timeout = max((wake_at - now_utc).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(reminders_changed.wait(), timeout) # Сон до ближайшего напоминания или до изменения данных.
+            except asyncio.TimeoutError:
+                pass
+
+            now_utc = datetime.now(timezone.utc)
+            due_by_user = {} # user_id -> наступившие напоминания, пользователь получает одно сообщение.
+            while heap and heap[0][0] <= now_utc: # Обработка всех наступивших напоминаний.
+                fire_at, medicine_id, dose_index = heapq.heappop(heap)
+                _, _, hh, mm, timezone_name, user_id, name, dose_to_send, dose_value, dosage_unit = reminders[(medicine_id, dose_index)]
+                heapq.heappush(heap, (next_fire_time(hh, mm, timezone_name, fire_at), medicine_id, dose_index)) # Следующее срабатывание.
+                if now_utc - fire_at > MISSED_REMINDER_GRACE:
+                    logging.warning("Напоминание для пользователя %s, лекарство %s на %s пропущено из-за опоздания планировщика.", user_id, name, fire_at)
+                    continue
+                logging.debug("Время отправлять напоминание для пользователя %s, лекарство %s, доза %s %s", user_id, name, dose_to_send, dosage_unit)
+                due_by_user.setdefault(user_id, []).append((medicine_id, name, dose_to_send, dose_value, dosage_unit))
+            if due_by_user:
+                try:
+                    await fire_reminders(bot, due_by_user)
+                except Exception as e:
+                    logging.error("Ошибка при обработке напоминаний: %s", e)
+            processed_until = now_utc
 
 async def main():
     """
@@ -105,10 +171,13 @@ async def main():
     dp.include_router(router) # Включение роутера обработчиков.
 
     await set_commands(bot) # Установка команд бота.
-    await create_tables() # Создание таблиц в базе данных, если их нет.
+    await create_tables() # Подключение к базе данных и создание таблиц, если их нет.
+    dp.shutdown.register(close_db) # Закрытие подключения к базе данных при остановке бота.
     asyncio.create_task(scheduler_setup(bot)) # Запуск планировщика задач в фоновом режиме.
 
     await dp.start_polling(bot) # Запуск поллинга для приема обновлений от Telegram.
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install() # Замена стандартного цикла событий asyncio на uvloop до его создания.
     asyncio.run(main())
\ No newline at end of file
@@ -1,23 +1,132 @@
 # database.py
 # Файл для работы с базой данных SQLite.
+import asyncio
+import json
+import logging
 import aiosqlite
-from typing import List, Tuple
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Tuple
 
 # database.py
 
 DATABASE_NAME = "medicine_bot.db" # Имя файла базы данных.
+logger = logging.getLogger(__name__)
 
-async def create_tables():
+# SQL запросы, выполняемые во время работы бота. Одни и те же объекты строк при каждом вызове
+# позволяют sqlite3 брать уже подготовленные запросы из кеша подключения.
+SQL_GET_TZ = "SELECT timezone FROM users WHERE user_id = ?"
+SQL_SET_TZ = "INSERT OR REPLACE INTO users (user_id, timezone) VALUES (?, ?)"
+SQL_INSERT_MEDICINE = """
+    INSERT INTO medicines (user_id, name, dosage, dosage_unit, doses_quantity, reminder_time, remaining_quantity)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_INSERT_REMINDER = "INSERT INTO medicine_reminders (medicine_id, user_id, hh, mm, dose_index, dose, dose_value) VALUES (?, ?, ?, ?, ?, ?, ?)"
+SQL_GET_USER_MEDICINES = "SELECT name, dosage, dosage_unit, doses_quantity, reminder_time, remaining_quantity, medicine_id FROM medicines WHERE user_id = ?"
+SQL_GET_REMINDER_SCHEDULE = """
+    SELECT r.medicine_id, r.dose_index, r.hh, r.mm, u.timezone, m.user_id, m.name, r.dose, r.dose_value, m.dosage_unit
+    FROM medicine_reminders r
+    JOIN medicines m USING (medicine_id)
+    JOIN users u ON u.user_id = m.user_id
+    WHERE u.timezone IS NOT NULL
+"""
+SQL_TAKE_DOSES = """
+    UPDATE medicines
+    SET remaining_quantity = remaining_quantity - taken.dose
+    FROM (SELECT json_extract(value, '$[0]') AS medicine_id, json_extract(value, '$[1]') AS dose FROM json_each(?)) AS taken
+    WHERE medicines.medicine_id = taken.medicine_id AND remaining_quantity > 0
+    RETURNING medicines.medicine_id, remaining_quantity
+"""
+SQL_DELETE_FINISHED = """
+    DELETE FROM medicines
+    WHERE remaining_quantity <= 0 AND medicine_id IN (SELECT value FROM json_each(?))
+    RETURNING medicine_id, user_id, name
+"""
+SQL_DELETE_REMINDERS = "DELETE FROM medicine_reminders WHERE medicine_id = ?"
+SQL_DELETE_USER_REMINDERS = "DELETE FROM medicine_reminders WHERE medicine_id = ? AND user_id = ?"
+SQL_DELETE_USER_MEDICINE = "DELETE FROM medicines WHERE medicine_id = ? AND user_id = ?"
+
+_db: aiosqlite.Connection | None = None # Единственное подключение к базе данных на все время работы бота.
+_write_lock = asyncio.Lock() # Не дает транзакциям разных корутин перемешиваться на общем подключении.
+reminders_changed = asyncio.Event() # Будит планировщик, когда меняются лекарства или часовые пояса пользователей.
+
+def get_db() -> aiosqlite.Connection:
     """
-    Создание таблиц 'users' и 'medicines' в базе данных, если они не существуют.
+    Получение открытого подключения к базе данных.
+    Подключение открывается в create_tables() при запуске бота.
+    """
+    if _db is None:
+        raise RuntimeError("Подключение к базе данных не открыто, сначала вызовите create_tables()")
+    return _db
+
+async def close_db():
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db: # Асинхронное подключение к базе данных.
+    Закрытие подключения к базе данных при остановке бота.
+    """
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+@asynccontextmanager
+async def _transaction() -> AsyncIterator[aiosqlite.Connection]:
+    """
+    Выполнение группы запросов на запись одной транзакцией с одним commit.
+    При ошибке изменения откатываются.
+    """
+    async with _write_lock:
+        db = get_db()
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit() # Применение изменений к базе данных.
+
+def _reminder_rows(medicine_id: int, user_id: int, reminder_time: str, dosage: str) -> List[Tuple]:
+    """
+    Разбор строк времени приема вида '8:00, 20:30' и дозировок вида '1, 0.5' в строки таблицы 'medicine_reminders'.
+    Каждому времени приема соответствует дозировка с тем же номером (или последняя, если дозировок меньше).
+    Дозировка сохраняется дважды: строкой для текста напоминания и числом для списания с остатка.
+    """
+    times = reminder_time.split(',') # Разделение времени приема.
+    dosages = [d.strip() for d in dosage.split(',')] # Разделение дозировок.
+    dosages += dosages[-1:] * (len(times) - len(dosages)) # Недостающие дозировки дополняются последней.
+    rows = []
+    for dose_index, (time_str, dose) in enumerate(zip(times, dosages)):
+        hh, mm = time_str.strip().split(':')
+        dose = dose.rstrip('0').rstrip('.') if '.' in dose else dose # Убираем лишние нули и точку из дробной части для красивого отображения дозировки.
+        dose_value = 1.0 # Доза по умолчанию для уменьшения остатка, если дозировку не удастся распарсить.
+        try:
+            dose_value = float(dose) # Попытка преобразования дозировки в число.
+        except ValueError:
+            logger.warning("Не удалось распарсить дозировку '%s' для medicine_id %s, используем дозу по умолчанию 1 для уменьшения остатка.", dose, medicine_id)
+        rows.append((medicine_id, user_id, int(hh), int(mm), dose_index, dose, dose_value))
+    return rows
+
+async def create_tables():
+    """
+    Открытие подключения к базе данных, создание таблиц 'users' и 'medicines', если они не существуют,
+    и пересборка таблицы 'medicine_reminders' по данным 'medicines'.
+    """
+    global _db
+    if _db is None:
+        _db = await aiosqlite.connect(DATABASE_NAME) # Асинхронное подключение к базе данных.
+        await _db.execute("PRAGMA journal_mode=WAL") # Чтение не блокируется записью.
+        await _db.execute("PRAGMA synchronous=NORMAL") # В режиме WAL fsync нужен только при checkpoint.
+        await _db.execute("PRAGMA temp_store=MEMORY")
+        await _db.execute("PRAGMA cache_size=-20000") # Кеш страниц около 20 МБ.
+        await _db.execute("PRAGMA mmap_size=268435456")
+    async with _transaction() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 timezone TEXT
             )
         """) # SQL запрос для создания таблицы 'users' для хранения часовых поясов пользователей.
+        # Очистка баз, созданных версией с кешем смещения от UTC: колонка users.utc_offset_min больше не используется.
+        user_columns = [row[1] for row in await db.execute_fetchall("PRAGMA table_info(users)")]
+        if "utc_offset_min" in user_columns:
+            await db.execute("ALTER TABLE users DROP COLUMN utc_offset_min")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS medicines (
                 medicine_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,93 +140,105 @@ async def create_tables():
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )
         """) # SQL запрос для создания таблицы 'medicines' для хранения информации о лекарствах.
-        await db.commit() # Применение изменений к базе данных.
+        # Индекс для поиска лекарств пользователя (/status, /delete); по префиксу user_id он же обслуживает WHERE user_id = ?.
+        await db.execute("CREATE INDEX IF NOT EXISTS ix_med_user_name ON medicines(user_id, name)")
+        # Таблица 'medicine_reminders' производна от 'medicines' (одна строка на каждое время приема),
+        # поэтому пересобирается при каждом запуске и всегда соответствует текущей схеме.
+        await db.execute("DROP INDEX IF EXISTS ix_rem_hhmm") # Индекс той же версии по (hh, mm), планировщик по нему больше не ищет.
+        await db.execute("DROP TABLE IF EXISTS medicine_reminders")
+        await db.execute("""
+            CREATE TABLE medicine_reminders (
+                medicine_id INTEGER,
+                user_id INTEGER,
+                hh INTEGER,
+                mm INTEGER,
+                dose_index INTEGER,
+                dose TEXT,  -- Дозировка для этого времени приема (для текста напоминания)
+                dose_value REAL,  -- Та же дозировка числом (для списания с остатка)
+                FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+            )
+        """) # SQL запрос для создания таблицы времени приема, по которой планировщик строит расписание.
+        await db.execute("CREATE INDEX ix_rem_medicine ON medicine_reminders(medicine_id)") # Для удаления времени приема вместе с лекарством.
+        medicines = await db.execute_fetchall("SELECT medicine_id, user_id, reminder_time, dosage FROM medicines")
+        await db.executemany(SQL_INSERT_REMINDER, [
+            reminder for medicine_id, user_id, reminder_time, dosage in medicines
+            for reminder in _reminder_rows(medicine_id, user_id, reminder_time, dosage)
+        ]) # Заполнение таблицы напоминаний для уже существующих лекарств.
 
 async def get_user_timezone(user_id: int) -> str | None:
     """
     Получение часового пояса пользователя из базы данных по user_id.
     Возвращает часовой пояс в виде строки или None, если часовой пояс не установлен.
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        async with db.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)) as cursor: # SQL запрос для получения часового пояса.
-            result = await cursor.fetchone()
-            return result[0] if result else None # Возвращает часовой пояс или None.
+    rows = await get_db().execute_fetchall(SQL_GET_TZ, (user_id,)) # SQL запрос для получения часового пояса.
+    return rows[0][0] if rows else None # Возвращает часовой пояс или None.
 
 async def set_user_timezone(user_id: int, timezone: str):
     """
     Установка или обновление часового пояса пользователя в базе данных.
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("INSERT OR REPLACE INTO users (user_id, timezone) VALUES (?, ?)", (user_id, timezone)) # SQL запрос для добавления или обновления часового пояса.
-        await db.commit() # Применение изменений к базе данных.
+    async with _transaction() as db:
+        await db.execute(SQL_SET_TZ, (user_id, timezone)) # SQL запрос для добавления или обновления часового пояса.
+    reminders_changed.set() # Напоминания пользователя нужно пересчитать в новом часовом поясе.
 
 async def add_medicine(user_id: int, name: str, dosage: str, dosage_unit: str, doses_quantity: int, reminder_time: str): # Добавлен dosage_unit
     """
     Добавление нового лекарства в базу данных.
     Изначальное количество оставшихся доз устанавливается равным общему количеству доз в упаковке.
+    Время приема сразу раскладывается по строкам таблицы 'medicine_reminders' в той же транзакции.
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("""
-            INSERT INTO medicines (user_id, name, dosage, dosage_unit, doses_quantity, reminder_time, remaining_quantity)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, name, dosage, dosage_unit, doses_quantity, reminder_time, doses_quantity)) # SQL запрос для добавления лекарства.
-        await db.commit() # Применение изменений к базе данных.
+    async with _transaction() as db:
+        cursor = await db.execute(SQL_INSERT_MEDICINE, (user_id, name, dosage, dosage_unit, doses_quantity, reminder_time, doses_quantity)) # SQL запрос для добавления лекарства.
+        await db.executemany(SQL_INSERT_REMINDER, _reminder_rows(cursor.lastrowid, user_id, reminder_time, dosage)) # Добавление времени приема.
+    reminders_changed.set() # Планировщику нужно добавить новые напоминания.
 
 async def get_medicines_for_user(user_id: int) -> List[Tuple]:
     """
     Получение списка всех лекарств для конкретного пользователя по user_id.
     Возвращает список кортежей с информацией о лекарствах.
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        async with db.execute("SELECT name, dosage, dosage_unit, doses_quantity, reminder_time, remaining_quantity FROM medicines WHERE user_id = ?", (user_id,)) as cursor: # SQL запрос для получения лекарств пользователя, добавлен dosage_unit.
-            return await cursor.fetchall() # Возвращает список найденных лекарств.
-
-async def get_all_medicines_with_time() -> List[Tuple]:
-    """
-    Получение списка всех лекарств из базы данных вместе с временем приема.
-    Используется для планировщика задач для проверки напоминаний.
-    """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        async with db.execute("SELECT medicine_id, user_id, name, dosage, dosage_unit, reminder_time, remaining_quantity FROM medicines") as cursor: # SQL запрос для получения всех лекарств с временем приема, добавлен dosage_unit.
-            return await cursor.fetchall() # Возвращает список всех лекарств.
-
-async def decrement_medicine_quantity(medicine_id: int, dosage_to_decrement: int):
-    """
-    Уменьшение оставшегося количества доз лекарства в базе данных.
-    Используется после отправки напоминания о приеме лекарства.
-    """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("""
-            UPDATE medicines
-            SET remaining_quantity = remaining_quantity - ?
-            WHERE medicine_id = ?
-        """, (dosage_to_decrement, medicine_id)) # SQL запрос для уменьшения количества оставшихся доз.
-        await db.commit() # Применение изменений к базе данных.
+    return await get_db().execute_fetchall(SQL_GET_USER_MEDICINES, (user_id,)) # SQL запрос для получения лекарств пользователя, добавлен dosage_unit.
 
-async def get_medicine_by_id(medicine_id: int) -> Tuple | None:
+async def get_reminder_schedule() -> List[Tuple]:
     """
-    Получение информации о лекарстве по его ID.
-    Используется для проверки и обновления данных о лекарстве после отправки напоминания.
+    Получение всех времен приема вместе с данными лекарства и часовым поясом пользователя одним запросом.
+    Используется планировщиком задач для построения расписания напоминаний.
     """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        async with db.execute("SELECT name, dosage, dosage_unit, doses_quantity, reminder_time, remaining_quantity, user_id FROM medicines WHERE medicine_id = ?", (medicine_id,)) as cursor: # SQL запрос для получения лекарства по ID, добавлен dosage_unit.
-            return await cursor.fetchone() # Возвращает информацию о лекарстве или None, если не найдено.
+    return await get_db().execute_fetchall(SQL_GET_REMINDER_SCHEDULE) # SQL запрос для получения расписания напоминаний.
 
-async def delete_medicine(medicine_id: int):
-    """
-    Удаление лекарства из базы данных по его ID.
-    Используется, когда количество оставшихся доз становится равным нулю.
-    """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("DELETE FROM medicines WHERE medicine_id = ?", (medicine_id,)) # SQL запрос для удаления лекарства.
-        await db.commit() # Применение изменений к базе данных.
+async def take_medicine_doses(doses: List[Tuple[int, float]]) -> List[Tuple]:
+    """
+    Списание принятых доз с остатков лекарств после отправки напоминаний.
+    doses - список кортежей (medicine_id, доза). Все списания и удаление закончившихся лекарств
+    выполняются одной транзакцией с одним commit.
+    Возвращает список кортежей (medicine_id, user_id, name) лекарств, которые закончились и были удалены.
+    """
+    if not doses:
+        return []
+    taken = {} # medicine_id -> суммарная доза, если у лекарства несколько приемов в одну минуту.
+    for medicine_id, dose in doses:
+        taken[medicine_id] = taken.get(medicine_id, 0) + dose
+    async with _transaction() as db:
+        # Дозы и список medicine_id передаются одним JSON-параметром, чтобы текст запросов не зависел от размера пачки.
+        updated = await db.execute_fetchall(SQL_TAKE_DOSES, (json.dumps(list(taken.items())),)) # Уменьшение количества оставшихся доз.
+        # Удаляются только лекарства, остаток которых закончился именно этим списанием.
+        finished_ids = [medicine_id for medicine_id, remaining_quantity in updated if remaining_quantity <= 0]
+        finished = await db.execute_fetchall(SQL_DELETE_FINISHED, (json.dumps(finished_ids),)) if finished_ids else [] # SQL запрос для удаления закончившихся лекарств.
+        await db.executemany(SQL_DELETE_REMINDERS, [(row[0],) for row in finished]) # Удаление их времени приема.
+    if finished:
+        reminders_changed.set() # Планировщику нужно убрать напоминания удаленных лекарств.
+    return finished
 
-async def delete_medicine_by_name_and_user(user_id: int, medicine_name: str) -> bool:
-    """
-    Удаление лекарства из базы данных по имени лекарства и user_id.
-    Возвращает True, если лекарство было удалено, и False, если нет (например, лекарство не найдено).
-    """
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute("DELETE FROM medicines WHERE user_id = ? AND name = ?", (user_id, medicine_name)) # SQL запрос для удаления лекарства по имени и user_id.
-        await db.commit() # Применение изменений к базе данных.
-        return cursor.rowcount > 0 # Возвращает True, если удалено больше 0 строк (т.е. лекарство было найдено и удалено).
\ No newline at end of file
+async def delete_medicines_by_id_and_user(user_id: int, medicine_ids: List[int]) -> bool:
+    """
+    Удаление лекарств из базы данных по первичному ключу medicine_id и user_id.
+    user_id в условии не дает удалить чужое лекарство.
+    Возвращает True, если лекарство было удалено, и False, если нет (например, оно уже закончилось и удалено).
+    """
+    params = [(medicine_id, user_id) for medicine_id in medicine_ids]
+    async with _transaction() as db:
+        await db.executemany(SQL_DELETE_USER_REMINDERS, params) # SQL запрос для удаления времени приема.
+        cursor = await db.executemany(SQL_DELETE_USER_MEDICINE, params) # SQL запрос для удаления лекарства по medicine_id и user_id.
+    if cursor.rowcount > 0:
+        reminders_changed.set() # Планировщику нужно убрать напоминания удаленного лекарства.
+    return cursor.rowcount > 0 # Возвращает True, если удалено больше 0 строк (т.е. лекарство было найдено и удалено).
\ No newline at end of file
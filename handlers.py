@@ -5,11 +5,11 @@ from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from datetime import datetime
 import re
 import logging
-from utils import get_timezone_from_location, GeocoderTimedOut
-from database import set_user_timezone, add_medicine, get_medicines_for_user, get_user_timezone, delete_medicine_by_name_and_user
+from middlewares import ThrottlingMiddleware
+from utils import LRUCache, get_timezone_from_location
+from database import set_user_timezone, add_medicine, get_medicines_for_user, get_user_timezone, delete_medicines_by_id_and_user
 
 # handlers.py
 # aiogram: 3.x.x
@@ -17,7 +17,53 @@ from database import set_user_timezone, add_medicine, get_medicines_for_user, ge
 
 # Инициализация роутера для обработки сообщений.
 router = Router()
-logging.basicConfig(level=logging.INFO)
+router.message.middleware(ThrottlingMiddleware(rate=0.5)) # Не чаще одного сообщения от пользователя в полсекунды.
+logger = logging.getLogger(__name__) # Настройка логирования выполняется в bot.py.
+
+_TIME_RE = re.compile(r"(?:[01]?[0-9]|2[0-3]):[0-5][0-9]", re.ASCII) # Регулярное выражение для формата времени ЧЧ:ММ (используется с fullmatch).
+# Список времен ЧЧ:ММ через запятую. Без re.ASCII: \s, как и str.strip(), пропускает любые пробелы, например неразрывный
+# с мобильных клавиатур, а цифры времени ограничены ASCII явным [0-9] в _TIME_RE.
+_TIMES_LIST_RE = re.compile(r"\s*{0}\s*(?:,\s*{0}\s*)*".format(_TIME_RE.pattern))
+# Список неотрицательных чисел через запятую. Как и в _TIMES_LIST_RE, \s пропускает любые пробелы, а цифры только ASCII.
+_DOSAGE_RE = re.compile(r"\s*[0-9]+(?:\.[0-9]+)?\s*(?:,\s*[0-9]+(?:\.[0-9]+)?\s*)*")
+MAX_QUANTITY = 100000 # Максимальное количество доз в упаковке, большие числа считаются ошибкой ввода.
+
+# Клавиатуры создаются один раз при импорте и переиспользуются во всех обработчиках.
+_LOCATION_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Отправить мою геолокацию", request_location=True)]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True # Клавиатура исчезнет после первого использования.
+)
+_DOSAGE_UNIT_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="Таблетки"),
+            KeyboardButton(text="гр"),
+            KeyboardButton(text="мл")
+        ]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+USER_TIMEZONE_CACHE_TTL = 3600 # Секунды, в течение которых часовой пояс пользователя берется из памяти без запроса к БД.
+USER_TIMEZONE_CACHE_SIZE = 10000 # Максимальное количество пользователей в кэше.
+_user_timezone_cache = LRUCache(USER_TIMEZONE_CACHE_SIZE, ttl=USER_TIMEZONE_CACHE_TTL) # user_id -> часовой пояс.
+
+async def _get_cached_user_timezone(user_id: int) -> str | None:
+    """
+    Получение часового пояса пользователя с кэшированием в памяти.
+    Отсутствие часового пояса не кэшируется, чтобы только что установленный пояс был виден сразу.
+    """
+    cached = _user_timezone_cache.get(user_id)
+    if cached is not None:
+        return cached
+    timezone = await get_user_timezone(user_id)
+    if timezone:
+        _user_timezone_cache.set(user_id, timezone)
+    return timezone
 
 # --- States для FSM (машины состояний) ---
 class TimezoneSetup(StatesGroup):
@@ -43,17 +89,10 @@ async def command_start_handler(message: types.Message, state: FSMContext) -> No
     Обработчик команды /start.
     Предлагает пользователю отправить геолокацию для установки часового пояса.
     """
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Отправить мою геолокацию", request_location=True)]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True # Клавиатура исчезнет после первого использования.
-    )
     await message.answer(
         "Привет! Я бот-напоминалка о приеме лекарств.\n"
         "Пожалуйста, отправьте свою геолокацию, чтобы я мог установить ваш часовой пояс.",
-        reply_markup=keyboard
+        reply_markup=_LOCATION_KB
     )
     await state.set_state(TimezoneSetup.WAITING_FOR_LOCATION) # Установка состояния ожидания геолокации.
 
@@ -63,21 +102,14 @@ async def timezone_command_handler(message: types.Message, state: FSMContext) ->
     Обработчик команды /timezone.
     Повторно предлагает пользователю отправить геолокацию для изменения часового пояса.
     """
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Отправить мою геолокацию", request_location=True)]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
     await message.answer(
         "Пожалуйста, отправьте свою геолокацию, чтобы установить часовой пояс.",
-        reply_markup=keyboard
+        reply_markup=_LOCATION_KB
     )
     await state.set_state(TimezoneSetup.WAITING_FOR_LOCATION) # Установка состояния ожидания геолокации.
 
 
-@router.message(TimezoneSetup.WAITING_FOR_LOCATION, F.content_type == types.ContentType.LOCATION)
+@router.message(TimezoneSetup.WAITING_FOR_LOCATION, F.location)
 async def location_handler(message: types.Message, state: FSMContext) -> None:
     """
     Обработчик геолокации, полученной от пользователя.
@@ -89,20 +121,15 @@ async def location_handler(message: types.Message, state: FSMContext) -> None:
         timezone = await get_timezone_from_location(latitude, longitude) # Получение часового пояса из utils.py.
         if timezone:
             await set_user_timezone(message.from_user.id, timezone) # Сохранение часового пояса в БД.
+            _user_timezone_cache.set(message.from_user.id, timezone) # Обновление кэша, чтобы /add сразу видел новый пояс.
             await message.answer(f"Ваш часовой пояс установлен как: {timezone}. Теперь вы можете использовать команды бота.", reply_markup=types.ReplyKeyboardRemove())
         else:
             await message.answer("Не удалось определить часовой пояс по геолокации. Пожалуйста, попробуйте отправить геолокацию еще раз.", reply_markup=types.ReplyKeyboardRemove())
-            await state.clear() # Сброс состояния.
-    except GeocoderTimedOut:
-        await message.answer("Извините, сервис определения часового пояса временно недоступен (timeout). Пожалуйста, попробуйте позже или убедитесь в стабильном интернет-соединении.", reply_markup=types.ReplyKeyboardRemove())
-        await state.clear() # Сброс состояния в случае timeout.
     except Exception as e: # Обработка других возможных ошибок геолокации
-        logging.error(f"Ошибка при определении часового пояса: {e}")
+        logger.error("Ошибка при определении часового пояса: %s", e)
         await message.answer("Произошла ошибка при определении часового пояса. Пожалуйста, попробуйте еще раз позже.", reply_markup=types.ReplyKeyboardRemove())
-        await state.clear() # Сброс состояния в случае ошибки.
-    finally: # Гарантированное снятие состояния после попытки обработки геолокации.
-        if await state.get_state() == TimezoneSetup.WAITING_FOR_LOCATION: # Проверка, что состояние еще установлено.
-            await state.clear()
+    finally: # Гарантированное снятие состояния после попытки обработки геолокации, одной записью в хранилище FSM.
+        await state.clear()
 
 
 @router.message(TimezoneSetup.WAITING_FOR_LOCATION)
@@ -120,7 +147,7 @@ async def add_medicine_command_handler(message: types.Message, state: FSMContext
     Обработчик команды /add.
     Начинает процесс добавления нового лекарства, проверяя установлен ли часовой пояс.
     """
-    user_timezone = await get_user_timezone(message.from_user.id) # Проверка, установлен ли часовой пояс.
+    user_timezone = await _get_cached_user_timezone(message.from_user.id) # Проверка, установлен ли часовой пояс (с кэшем в памяти).
     if not user_timezone:
         await message.answer("Перед добавлением лекарств, пожалуйста, установите свой часовой пояс, используя команду /start или /timezone и отправив геолокацию.")
         return
@@ -143,28 +170,16 @@ async def get_medicine_dosage(message: types.Message, state: FSMContext) -> None
     Обработчик состояния WAITING_FOR_DOSAGE.
     Получает дозировку лекарства от пользователя и переходит к следующему состоянию - выбору ед. измерения.
     """
-    dosages_text = message.text
-    dosages = [d.strip() for d in dosages_text.split(',')] # Разделение дозировок, если их несколько.
-    for dosage in dosages:
-        try:
-            float(dosage) # Проверка, что все введенные значения - числа.
-        except ValueError:
-            await message.answer("Пожалуйста, вводите только числа в качестве дозировки (например, '1' или '0.5'). Если дозировок несколько, разделите их запятой.")
-            return
-    await state.update_data(medicine_dosage=dosages_text) # Сохранение дозировки в FSMContext.
+    dosages_text = message.text or ""
+    dosages = []
+    if _DOSAGE_RE.fullmatch(dosages_text): # Проверка всего списка одним регулярным выражением.
+        dosages = [float(d) for d in dosages_text.split(',')] # После проверки каждое значение гарантированно преобразуется в число.
+    if not dosages or min(dosages) <= 0: # Нулевая доза никогда не уменьшала бы остаток лекарства.
+        await message.answer("Пожалуйста, вводите только положительные числа в качестве дозировки (например, '1' или '0.5'). Если дозировок несколько, разделите их запятой.")
+        return
+    await state.update_data(medicine_dosage=dosages_text, medicine_dosages=dosages) # Сохранение дозировки и списка доз числами в FSMContext.
     await state.set_state(AddMedicine.WAITING_FOR_DOSAGE_UNIT) # Переход к состоянию ожидания выбора ед. измерения.
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="Таблетки"),
-                KeyboardButton(text="гр"),
-                KeyboardButton(text="мл")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    await message.answer("Выберите единицу измерения дозировки:", reply_markup=keyboard)
+    await message.answer("Выберите единицу измерения дозировки:", reply_markup=_DOSAGE_UNIT_KB)
 
 
 @router.message(AddMedicine.WAITING_FOR_DOSAGE_UNIT, F.text.in_({"Таблетки", "гр", "мл"}))
@@ -184,18 +199,7 @@ async def wrong_dosage_unit_handler(message: types.Message, state: FSMContext) -
     """
     Обработчик для некорректного выбора ед. измерения.
     """
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="Таблетки"),
-                KeyboardButton(text="гр"),
-                KeyboardButton(text="мл")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    await message.answer("Пожалуйста, выберите единицу измерения, используя кнопки:", reply_markup=keyboard)
+    await message.answer("Пожалуйста, выберите единицу измерения, используя кнопки:", reply_markup=_DOSAGE_UNIT_KB)
 
 
 @router.message(AddMedicine.WAITING_FOR_QUANTITY)
@@ -203,43 +207,38 @@ async def get_medicine_quantity(message: types.Message, state: FSMContext) -> No
     """
     Обработчик состояния WAITING_FOR_QUANTITY.
     Получает общее количество доз лекарства от пользователя и переходит к следующему состоянию.
-    Проверяет, что введено целое число.
+    Проверяет, что введено целое число от 1 до MAX_QUANTITY.
     """
-    if not message.text.isdigit():
-        await message.answer("Пожалуйста, введите целое число для общего количества доз.")
+    try:
+        quantity = int(message.text)
+    except (TypeError, ValueError):
+        quantity = 0
+    if not 0 < quantity <= MAX_QUANTITY:
+        await message.answer(f"Пожалуйста, введите целое число от 1 до {MAX_QUANTITY} для общего количества доз.")
         return
-    await state.update_data(medicine_quantity=int(message.text)) # Сохранение количества доз в FSMContext.
+    await state.update_data(medicine_quantity=quantity) # Сохранение количества доз в FSMContext.
     await state.set_state(AddMedicine.WAITING_FOR_TIMES) # Переход к состоянию ожидания времени приема.
     await message.answer("Введите время приема лекарства (можно несколько через запятую, например '8:00, 12:30, 20:00'):")
 
-@router.message(AddMedicine.WAITING_FOR_TIMES)
+@router.message(AddMedicine.WAITING_FOR_TIMES, F.text.regexp(_TIMES_LIST_RE, mode="fullmatch"))
 async def get_medicine_time(message: types.Message, state: FSMContext) -> None:
     """
     Обработчик состояния WAITING_FOR_TIMES.
-    Получает время приема лекарства от пользователя, проверяет формат и сохраняет данные лекарства.
+    Получает время приема лекарства от пользователя и сохраняет данные лекарства.
+    Формат времени уже проверен фильтром, неверный ввод обрабатывает wrong_medicine_time_handler.
     """
     times_text = message.text
     times = [t.strip() for t in times_text.split(',')] # Разделение времени приема, если их несколько.
-    time_format = r"^([0-9]|[01][0-9]|2[0-3]):[0-5][0-9]$" # Регулярное выражение для формата времени ЧЧ:ММ.
-
-    for time_str in times:
-        if not re.match(time_format, time_str):
-            await message.answer("Неверный формат времени: '{}'. Пожалуйста, используйте формат ЧЧ:ММ (например, 8:00 или 21:30) для всех времен.".format(time_str))
-            return # Выход из функции, если формат времени неверный.
-
-    await state.update_data(medicine_time=times_text) # Сохранение времени приема в FSMContext.
 
     data = await state.get_data() # Получение всех данных из FSMContext.
     medicine_name = data.get("medicine_name")
     medicine_dosage = data.get("medicine_dosage")
+    medicine_dosages = data.get("medicine_dosages")
     medicine_dosage_unit = data.get("medicine_dosage_unit")
     medicine_quantity = data.get("medicine_quantity")
-    medicine_time = data.get("medicine_time")
-
-    dosages_list = [d.strip() for d in medicine_dosage.split(',')] # Разделение дозировок для проверки соответствия количеству времен.
-    times_list = [t.strip() for t in medicine_time.split(',')] # Разделение времени для проверки соответствия количеству дозировок.
+    medicine_time = times_text
 
-    if len(dosages_list) != len(times_list):
+    if len(medicine_dosages) != len(times): # Уже разделенный список времен используется повторно.
         await message.answer("Количество дозировок и времен приема должно совпадать. Пожалуйста, проверьте введенное время и дозировки.")
         return
 
@@ -247,6 +246,22 @@ async def get_medicine_time(message: types.Message, state: FSMContext) -> None:
     await message.answer(f"Лекарство '{medicine_name}' (дозировки: {medicine_dosage} {medicine_dosage_unit}), время приема: {medicine_time} добавлено.")
     await state.clear() # Сброс состояния после успешного добавления лекарства.
 
+@router.message(AddMedicine.WAITING_FOR_TIMES)
+async def wrong_medicine_time_handler(message: types.Message, state: FSMContext) -> None:
+    """
+    Обработчик для времени приема в неверном формате.
+    Сообщает пользователю первое неверное значение.
+    """
+    times_text = message.text
+    if not times_text: # Не текстовое сообщение, цитировать нечего.
+        await message.answer("Пожалуйста, введите время приема текстом в формате ЧЧ:ММ (например, 8:00 или 21:30).")
+        return
+    times = [t.strip() for t in times_text.split(',')]
+    wrong_time = next((time_str for time_str in times if not _TIME_RE.fullmatch(time_str)), None) # Первое время в неверном формате.
+    if not wrong_time: # Пустой элемент (например, лишняя запятая) или ошибка вне отдельных времен - показывается весь ввод.
+        wrong_time = times_text
+    await message.answer("Неверный формат времени: '{}'. Пожалуйста, используйте формат ЧЧ:ММ (например, 8:00 или 21:30) для всех времен.".format(wrong_time))
+
 @router.message(Command("status"))
 async def status_command_handler(message: types.Message) -> None:
     """
@@ -255,11 +270,11 @@ async def status_command_handler(message: types.Message) -> None:
     """
     medicines = await get_medicines_for_user(message.from_user.id) # Получение списка лекарств из базы данных.
     if medicines:
-        response = "Ваши лекарства:\n"
+        lines = ["Ваши лекарства:"] # Строки ответа собираются в список и соединяются один раз.
         for medicine in medicines:
-            name, dosage, dosage_unit, quantity, time, remaining_quantity = medicine # Распаковка данных о лекарстве, добавлен dosage_unit.
-            response += f"- {name} (дозировка: {dosage} {dosage_unit}), {quantity} доз в упаковке, осталось: {remaining_quantity}, время приема: {time}\n"
-        await message.answer(response)
+            name, dosage, dosage_unit, quantity, time, remaining_quantity, _ = medicine # Распаковка данных о лекарстве, добавлен dosage_unit.
+            lines.append(f"- {name} (дозировка: {dosage} {dosage_unit}), {quantity} доз в упаковке, осталось: {remaining_quantity}, время приема: {time}")
+        await message.answer("\n".join(lines))
     else:
         await message.answer("У вас пока нет добавленных лекарств. Используйте команду /add для добавления.")
 
@@ -271,12 +286,15 @@ async def delete_medicine_command_handler(message: types.Message, state: FSMCont
     """
     medicines = await get_medicines_for_user(message.from_user.id)
     if medicines:
-        response = "Список ваших лекарств для удаления:\n"
+        lines = ["Список ваших лекарств для удаления:"]
+        medicines_to_delete = {} # Название в нижнем регистре -> (название, список medicine_id), для удаления без повторного запроса к БД.
         for index, medicine in enumerate(medicines):
-            name, dosage, dosage_unit, quantity, time, remaining_quantity = medicine
-            response += f"{index + 1}. {name} (дозировка: {dosage} {dosage_unit})\n"
-        response += "\nВведите название лекарства, которое вы хотите удалить:"
-        await message.answer(response)
+            name, dosage, dosage_unit, quantity, time, remaining_quantity, medicine_id = medicine
+            lines.append(f"{index + 1}. {name} (дозировка: {dosage} {dosage_unit})")
+            medicines_to_delete.setdefault(name.strip().lower(), (name, []))[1].append(medicine_id)
+        lines.append("\nВведите название лекарства, которое вы хотите удалить:")
+        await message.answer("\n".join(lines))
+        await state.update_data(medicines_to_delete=medicines_to_delete)
         await state.set_state(DeleteMedicine.WAITING_FOR_MEDICINE_NAME_TO_DELETE) # Установка состояния ожидания ввода названия лекарства для удаления.
     else:
         await message.answer("У вас нет добавленных лекарств для удаления. Используйте команду /add, чтобы добавить лекарства.")
@@ -289,18 +307,20 @@ async def get_medicine_name_to_delete(message: types.Message, state: FSMContext)
     """
     medicine_name_to_delete = message.text
     user_id = message.from_user.id
-    deleted = await delete_medicine_by_name_and_user(user_id, medicine_name_to_delete) # Попытка удаления лекарства.
+    data = await state.get_data()
+    medicine = data.get("medicines_to_delete", {}).get((medicine_name_to_delete or "").strip().lower()) # Поиск без учета регистра среди показанных лекарств.
+    deleted = medicine is not None and await delete_medicines_by_id_and_user(user_id, medicine[1]) # Запрос к БД только для существующего лекарства, по первичному ключу.
     if deleted:
-        await message.answer(f"Лекарство '{medicine_name_to_delete}' успешно удалено из списка напоминаний.")
+        await message.answer(f"Лекарство '{medicine[0]}' успешно удалено из списка напоминаний.")
     else:
         await message.answer(f"Не удалось найти и удалить лекарство '{medicine_name_to_delete}'. Пожалуйста, убедитесь, что название введено верно и лекарство существует в вашем списке.")
     await state.clear() # Сброс состояния после попытки удаления.
 
 
-@router.message()
+@router.message(F.text) # Стикеры, фото и служебные сообщения отсекаются фильтром, не доходя до обработчика.
 async def echo_handler(message: types.Message) -> None:
     """
-    Обработчик для всех текстовых сообщений, не являющихся командами.
+    Обработчик для всех текстовых сообщений, не обработанных другими обработчиками (включая неизвестные команды).
     Сообщает пользователю о непонимании команды.
     """
     await message.answer("Я не понимаю эту команду. Используйте /start, /add, /status, /delete или /timezone.")
\ No newline at end of file
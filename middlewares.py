@@ -0,0 +1,45 @@
+# middlewares.py
+# Файл промежуточных обработчиков (middleware) бота.
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict
+from utils import LRUCache
+
+# middlewares.py
+# aiogram: 3.x.x
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты сообщений от одного пользователя.
+    Сообщения, пришедшие раньше чем через rate секунд после последнего обработанного, отбрасываются,
+    чтобы один пользователь не расходовал общий лимит бота на отправку ответов (30 сообщений в секунду).
+    О превышении пользователь предупреждается один раз, пока не отправит сообщение после паузы.
+    Ответы внутри сценария (например, шаги /add) не ограничиваются, чтобы введенные данные не терялись.
+    """
+    def __init__(self, rate: float = 0.5, maxsize: int = 10000):
+        self.rate = rate # Минимальный интервал между сообщениями пользователя в секундах.
+        # user_id -> (время последнего обработанного сообщения по monotonic(), было ли уже предупреждение).
+        # Размер ограничен, вытесняются давно писавшие пользователи, чьи записи уже не нужны.
+        self.last_handled = LRUCache(maxsize)
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Сообщения без отправителя (например, из каналов) и ответы пользователя в активном состоянии FSM не ограничиваются.
+        # raw_state уже загружен FSMContextMiddleware, повторного обращения к хранилищу нет.
+        if event.from_user is None or data.get("raw_state") is not None:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        now = monotonic()
+        handled_at, warned = self.last_handled.get(user_id, (float("-inf"), False))
+        if now - handled_at < self.rate:
+            if not warned:
+                self.last_handled.set(user_id, (handled_at, True))
+                await event.answer("Слишком много сообщений подряд, это сообщение не обработано. Пожалуйста, подождите секунду и отправьте его еще раз.")
+            return None # Сообщение не передается обработчику.
+        self.last_handled.set(user_id, (now, False))
+        return await handler(event, data)
\ No newline at end of file
@@ -0,0 +1,63 @@
+# tests/test_middlewares.py
+# Тесты ограничения частоты сообщений ThrottlingMiddleware.
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from middlewares import ThrottlingMiddleware
+
+class FakeMessage:
+    """
+    Минимальная замена types.Message: отправитель и запись ответов бота.
+    """
+    def __init__(self, user_id: int | None):
+        self.from_user = SimpleNamespace(id=user_id) if user_id is not None else None
+        self.answers = []
+
+    async def answer(self, text: str):
+        self.answers.append(text)
+
+async def handler(event, data):
+    return "handled"
+
+class ThrottlingMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    async def call(self, middleware, message, now, raw_state=None):
+        with mock.patch("middlewares.monotonic", return_value=now):
+            return await middleware(handler, message, {"raw_state": raw_state})
+
+    async def test_drops_fast_messages_and_warns_once(self):
+        middleware = ThrottlingMiddleware(rate=0.5)
+        messages = [FakeMessage(1) for _ in range(3)]
+        self.assertEqual(await self.call(middleware, messages[0], 100.0), "handled")
+        self.assertIsNone(await self.call(middleware, messages[1], 100.1))
+        self.assertIsNone(await self.call(middleware, messages[2], 100.2))
+        self.assertEqual(len(messages[1].answers), 1) # Предупреждение только на первое отброшенное сообщение.
+        self.assertEqual(messages[2].answers, [])
+
+    async def test_passes_after_rate_and_warns_again(self):
+        middleware = ThrottlingMiddleware(rate=0.5)
+        await self.call(middleware, FakeMessage(1), 100.0)
+        await self.call(middleware, FakeMessage(1), 100.1)
+        self.assertEqual(await self.call(middleware, FakeMessage(1), 100.6), "handled")
+        message = FakeMessage(1)
+        self.assertIsNone(await self.call(middleware, message, 100.7))
+        self.assertEqual(len(message.answers), 1) # После паузы серия начинается заново.
+
+    async def test_users_are_throttled_independently(self):
+        middleware = ThrottlingMiddleware(rate=0.5)
+        await self.call(middleware, FakeMessage(1), 100.0)
+        self.assertEqual(await self.call(middleware, FakeMessage(2), 100.1), "handled")
+
+    async def test_fsm_state_and_anonymous_messages_are_not_throttled(self):
+        middleware = ThrottlingMiddleware(rate=0.5)
+        await self.call(middleware, FakeMessage(1), 100.0)
+        self.assertEqual(await self.call(middleware, FakeMessage(1), 100.1, raw_state="AddMedicine:WAITING_FOR_NAME"), "handled")
+        self.assertEqual(await self.call(middleware, FakeMessage(None), 100.1), "handled")
+
+    async def test_state_is_bounded(self):
+        middleware = ThrottlingMiddleware(rate=0.5, maxsize=3)
+        for user_id in range(10):
+            await self.call(middleware, FakeMessage(user_id), 100.0)
+        self.assertEqual(len(middleware.last_handled), 3)
+
+if __name__ == "__main__":
+    unittest.main()
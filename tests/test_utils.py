@@ -0,0 +1,49 @@
+# tests/test_utils.py
+# Тесты ограниченного LRU-кэша из utils.py.
+import unittest
+from unittest import mock
+from utils import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_get_missing_returns_default(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", 0), 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a") # "a" становится недавно использованным, вытесняться должен "b".
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_set_existing_key_does_not_grow(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("a", 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("a"), 2)
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(10, ttl=60)
+        with mock.patch("utils.monotonic", return_value=1000.0):
+            cache.set("a", 1)
+        with mock.patch("utils.monotonic", return_value=1059.0):
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch("utils.monotonic", return_value=1060.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0) # Устаревшая запись удаляется при обращении.
+
+    def test_without_ttl_entries_do_not_expire(self):
+        cache = LRUCache(10)
+        with mock.patch("utils.monotonic", return_value=0.0):
+            cache.set("a", 1)
+        with mock.patch("utils.monotonic", return_value=1e9):
+            self.assertEqual(cache.get("a"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,27 +1,75 @@
 # utils.py
 # Файл с утилитарными функциями, в данном случае для определения часового пояса по геолокации.
-from geopy.geocoders import Nominatim
 from timezonefinder import TimezoneFinder
-from geopy.exc import GeocoderTimedOut # Импорт исключения для обработки timeout.
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import asyncio
+import functools
 import logging
 
 # utils.py
 
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш в памяти: при переполнении удаляется давно не использованная запись.
+    Если задан ttl (в секундах), записи старше ttl считаются отсутствующими.
+    """
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # ключ -> (значение, момент устаревания по monotonic() или None), в порядке LRU.
+
+    def get(self, key, default=None):
+        """
+        Получение значения по ключу с отметкой о недавнем использовании. Возвращает default, если записи нет или она устарела.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= monotonic():
+            del self._data[key] # Устаревшая запись удаляется при обращении.
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Сохранение значения по ключу.
+        """
+        self._data[key] = (value, monotonic() + self.ttl if self.ttl is not None else None)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False) # Удаление давно не использованной записи.
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_TF = TimezoneFinder(in_memory=True) # Данные полигонов часовых поясов загружаются в память один раз при запуске.
+_TF_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="timezonefinder") # Единственный поток для поиска, _TF не потокобезопасен.
+TIMEZONE_CACHE_SIZE = 10000 # Максимальное количество запомненных координат.
+_timezone_cache = LRUCache(TIMEZONE_CACHE_SIZE) # (широта, долгота) с точностью ~100 м -> часовой пояс.
+
 async def get_timezone_from_location(latitude: float, longitude: float) -> str | None:
     """
     Асинхронная функция для определения часового пояса по координатам широты и долготы.
-    Использует сервисы geopy и timezonefinder.
+    Использует timezonefinder, который ищет часовой пояс по координатам локально, без обращения к сети.
+    Результаты запоминаются по координатам, округленным до 3 знаков (~100 м).
     """
-    geolocator = Nominatim(user_agent="medicine_reminder_bot", timeout=10) # Инициализация geolocator с user_agent и timeout.
-    tf = TimezoneFinder() # Инициализация TimezoneFinder для поиска часового пояса.
+    cache_key = (round(latitude, 3), round(longitude, 3))
+    cached = _timezone_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        location = geolocator.reverse((latitude, longitude), exactly_one=True, timeout=10) # Получение обратного геокодирования с timeout.
-        if location:
-            timezone = tf.timezone_at(lng=longitude, lat=latitude) # Определение часового пояса по координатам.
-            return timezone # Возвращает название часового пояса, например "Europe/Moscow".
-    except GeocoderTimedOut:
-        raise GeocoderTimedOut("Service timed out") # Проброс исключения GeocoderTimedOut для обработки в handlers.py.
+        # Поиск по полигонам в отдельном потоке, чтобы не блокировать обработку других сообщений. Поток один:
+        # _TF читает общие BytesIO через seek() и read(), и параллельные поиски сбивают друг другу позицию чтения.
+        timezone = await asyncio.get_running_loop().run_in_executor(_TF_EXECUTOR, functools.partial(_TF.timezone_at, lng=longitude, lat=latitude))
     except Exception as e:
-        logging.error(f"Geocoder error: {e}") # Логирование ошибок geocoder.
+        logger.error("Timezone lookup error: %s", e) # Логирование ошибок определения часового пояса.
         return None # Возвращает None в случае ошибки.
-    return None # Возвращает None, если не удалось определить часовой пояс.
\ No newline at end of file
+    if timezone:
+        _timezone_cache.set(cache_key, timezone)
+    return timezone # Возвращает название часового пояса, например "Europe/Moscow", или None.
\ No newline at end of file